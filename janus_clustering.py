@@ -1,25 +1,226 @@
 import os
+import queue
+import threading
+import subprocess
+
+# Persist numba JIT output for UMAP/HDBSCAN across runs; must be set before they are imported
+os.environ.setdefault("NUMBA_CACHE_DIR", "./.numba_cache")
 
 import cv2
 import torch
+import torch.multiprocessing as mp
 import hdbscan
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from umap import UMAP
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from sklearn.neighbors import NearestNeighbors
 import plotly.express as px
 from pymilvus import FieldSchema, Collection, connections, CollectionSchema, DataType
 
 from dotenv import load_dotenv
 load_dotenv()
 
+cv2.setUseOptimized(True)
+
 from janus_embedding import JanusEmbedder
 
+try:
+    from torchcodec.decoders import VideoDecoder
+except ImportError:
+    VideoDecoder = None
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Stand-in for zero distances (duplicate frames), which a sparse graph would otherwise drop
+MIN_DISTANCE = 1e-8
+
+
+def open_capture(video_path):
+    """Open a video with the FFMPEG backend, requesting hardware decoding (VA-API/NVDEC/QSV) when available"""
+    # Acceleration can only be requested at open time; setting it afterwards is a no-op
+    return cv2.VideoCapture(
+        video_path,
+        cv2.CAP_FFMPEG,
+        [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    )
+
+
+def transcode_to_mjpeg(video_path, output_path=None):
+    """Transcode a video to MJPEG once, so repeated decodes run at thousands of FPS. Returns the output path"""
+    if output_path is None:
+        output_path = os.path.splitext(video_path)[0] + "_mjpeg.avi"
+    if os.path.exists(output_path):
+        return output_path
+    
+    # Write to a temp file and move it into place, so an interrupted run never leaves a
+    # truncated file that would be reused next time
+    root, ext = os.path.splitext(output_path)
+    tmp_path = f"{root}.partial{ext}"
+    
+    print(f"[{pd.Timestamp.now()}] Transcoding {video_path} to MJPEG...")
+    ffmpeg_cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", video_path, "-c:v", "mjpeg", "-q:v", "3", "-an", tmp_path]
+    try:
+        subprocess.run(ffmpeg_cmd, check=True)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def read_frames(frames, read_q, stop_event, errors):
+    """Reader thread: push (frame, timestamp) pairs into the bounded read_q, then a None sentinel.
+
+    Decoding happens here, off the main thread, so it overlaps with GPU encoding.
+    Setting stop_event makes the reader give up early and release the decoder.
+    """
+    try:
+        for item in frames:
+            while not stop_event.is_set():
+                try:
+                    read_q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop_event.is_set():
+                break
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if hasattr(frames, "close"):
+            frames.close()
+        if not stop_event.is_set():
+            read_q.put(None)
+
+
+class PinnedFrameBuffer:
+    """Reusable pinned host buffer for uploading batches of BGR frames to the GPU"""
+
+    def __init__(self):
+        self.buffer = None
+        self.copied = None  # CUDA event recorded after the last upload was enqueued
+
+    def upload(self, frames):
+        """Stack frames straight into the pinned buffer and copy them to the GPU as one [B, H, W, 3] tensor"""
+        if self.buffer is None or self.buffer.shape[1:] != frames[0].shape or len(self.buffer) < len(frames):
+            self.buffer = torch.empty((len(frames), *frames[0].shape), dtype=torch.uint8, pin_memory=True)
+        elif self.copied is not None:
+            # The previous asynchronous copy may still be reading the buffer
+            self.copied.synchronize()
+        
+        host = self.buffer[:len(frames)]
+        np.stack(frames, out=host.numpy())
+        device_batch = host.to("cuda", non_blocking=True)
+        self.copied = torch.cuda.Event()
+        self.copied.record()
+        return device_batch
+
+
+def encode_batch(embedder, batch, upload_buffer):
+    """Encode a list of (frame, timestamp) pairs into pooled float32 CUDA embeddings of shape [B, D]"""
+    if isinstance(batch[0][0], torch.Tensor):
+        # NVDEC frames are already RGB and on the GPU
+        batch_rgb = torch.stack([frame for frame, _ in batch])
+    else:
+        # Upload the BGR batch once, then flip channels to RGB on the GPU
+        batch_bgr = upload_buffer.upload([frame for frame, _ in batch])
+        batch_rgb = batch_bgr.flip(-1).permute(0, 3, 1, 2)
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+        return embedder.encode_image_batch(batch_rgb).mean(dim=-2).float()  # Pool tokens on the GPU
+
+
+def iter_batches(frames, batch_size, prefetch=64):
+    """Group (frame, timestamp) pairs into lists of up to batch_size, decoding on a reader thread.
+
+    The reader fills a bounded queue of `prefetch` frames, so decoding overlaps with
+    whatever consumes the batches while memory stays bounded.
+    """
+    read_q = queue.Queue(maxsize=prefetch)
+    stop_event = threading.Event()
+    errors = []
+    reader_thread = threading.Thread(target=read_frames, args=(frames, read_q, stop_event, errors), daemon=True)
+    reader_thread.start()
+    
+    try:
+        eof = False
+        while not eof:
+            batch = []
+            while len(batch) < batch_size:
+                item = read_q.get()
+                if item is None:
+                    eof = True
+                    break
+                batch.append(item)
+            if batch:
+                yield batch
+    finally:
+        # Unblocks the reader if the consumer stopped before EOF
+        stop_event.set()
+    
+    reader_thread.join()
+    if errors:
+        raise errors[0]
+
+
+def encode_chunks(embedder, batches, batch_size, chunk_size, errors=None):
+    """Encode batches of (frame, timestamp) pairs, yielding (float32 embeddings [n, D], timestamps) chunks.
+
+    Pooled embeddings accumulate in a preallocated CUDA buffer and are copied to the
+    host once per chunk of up to chunk_size frames instead of once per batch.
+    Encoding stops early once a downstream stage records an error in `errors`.
+    """
+    upload_buffer = PinnedFrameBuffer()
+    pooled = None
+    pooled_count = 0
+    pooled_timestamps = []
+    
+    for batch in batches:
+        if errors:
+            batches.close()  # Stops the reader instead of decoding the rest of the video
+            return
+        emb = encode_batch(embedder, batch, upload_buffer)
+        if pooled is None:
+            pooled = torch.empty((max(chunk_size, batch_size), emb.shape[-1]), dtype=torch.float32, device=emb.device)
+        if pooled_count + len(emb) > len(pooled):
+            yield pooled[:pooled_count].cpu().numpy(), pooled_timestamps
+            pooled_count, pooled_timestamps = 0, []
+        pooled[pooled_count:pooled_count + len(emb)] = emb
+        pooled_count += len(emb)
+        pooled_timestamps.extend(timestamp for _, timestamp in batch)
+    
+    if pooled_count:
+        yield pooled[:pooled_count].cpu().numpy(), pooled_timestamps
+
+
+def encode_shard(rank, video_path, shards, model_path, compile_vision, frame_interval, batch_size, chunk_size, prefetch, result_q):
+    """torch.multiprocessing worker: encode one shard of the video on its own GPU.
+
+    Chunks are streamed back through the bounded result_q as they are produced,
+    followed by a None sentinel.
+    """
+    device = rank + 1  # GPU 0 and shard 0 belong to the parent process
+    torch.cuda.set_device(device)
+    embedder = JanusEmbedder(model_path, compile_vision=compile_vision, compile_batch_size=batch_size)
+    frames = JanusClustering.extract_frames(video_path, frame_interval, *shards[device], device=device)
+    for chunk in encode_chunks(embedder, iter_batches(frames, batch_size, prefetch), batch_size, chunk_size):
+        result_q.put(chunk)
+    result_q.put(None)
+
 
 class JanusClustering:
-    def __init__(self, model_path, milvus_uri, milvus_user, milvus_password):
-        # Initialize Janus embedder
-        self.embedder = JanusEmbedder(model_path)
+    def __init__(self, model_path, milvus_uri, milvus_user, milvus_password, compile_vision=False, batch_size=32):
+        # Initialize Janus embedder; a compiled encoder is specialised to the encode batch size
+        self.model_path = model_path
+        self.compile_vision = compile_vision
+        self.batch_size = batch_size
+        self.embedder = JanusEmbedder(model_path, compile_vision=compile_vision, compile_batch_size=batch_size)
         
         # Connect to Milvus
         connections.connect(
@@ -35,6 +236,7 @@ class JanusClustering:
             dim = 4096
         else:
             raise ValueError(f"Unknown model in path: {model_path}")
+        self.dim = dim
 
         # Define collection schema with timestamp field
         fields = [
@@ -56,123 +258,335 @@ class JanusClustering:
         Collection("janus_data").drop()
         print(f"[{pd.Timestamp.now()}] Collection dropped successfully")
 
-    def extract_frames(self, video_path, frame_interval=1):
-        """Extract frames from video at specified interval"""
-        cap = cv2.VideoCapture(video_path)
-        frame_list = []
-        timestamps = []
-        frame_count = 0
+    @staticmethod
+    def extract_frames(video_path, frame_interval=1, start_frame=0, end_frame=None, device=None):
+        """Lazily extract frames from video at specified interval, yielding (frame, timestamp).
+
+        When torchcodec and CUDA are available, frames are decoded with NVDEC on
+        `device` and yielded as RGB CUDA tensors of shape [3, H, W]. Otherwise OpenCV
+        decodes them on the CPU into BGR numpy arrays. Only frames in
+        [start_frame, end_frame) are decoded.
+
+        The generator usually runs on a reader thread, whose current CUDA device is
+        always 0, so callers on another GPU must pass `device` explicitly.
+        """
+        if VideoDecoder is not None and torch.cuda.is_available():
+            yield from JanusClustering._extract_frames_cuda(video_path, frame_interval, start_frame, end_frame, device)
+            return
+        
+        cap = open_capture(video_path)
+        frame_count = start_frame
+        extracted = 0
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         fps = cap.get(cv2.CAP_PROP_FPS)
+        if end_frame is None:
+            end_frame = float("inf")  # CAP_PROP_FRAME_COUNT is an estimate; read until EOF
+        if start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
         
         print(f"[{pd.Timestamp.now()}] Starting frame extraction from {video_path}")
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            if frame_count % frame_interval == 0:
-                frame_list.append(frame)
-                timestamp = frame_count / fps
-                timestamps.append(timestamp)
-                if frame_count % 100 == 0:
-                    progress = (frame_count / total_frames) * 100
-                    print(f"[{pd.Timestamp.now()}] Extracted {frame_count}/{total_frames} frames ({progress:.1f}%)")
-            frame_count += 1
-            
+        try:
+            while frame_count < end_frame:
+                # Only sampled frames are retrieved; skipped frames avoid the BGR conversion and copy
+                ret = cap.grab()
+                if not ret:
+                    break
+                    
+                if frame_count % frame_interval == 0:
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        break
+                    yield frame, frame_count / fps
+                    extracted += 1
+                    if frame_count % 100 == 0 and total_frames > 0:
+                        progress = (frame_count / total_frames) * 100
+                        print(f"[{pd.Timestamp.now()}] Extracted {frame_count}/{total_frames} frames ({progress:.1f}%)")
+                frame_count += 1
+        finally:
+            cap.release()
+        print(f"[{pd.Timestamp.now()}] Frame extraction complete. Extracted {extracted} frames")
+
+    @staticmethod
+    def _extract_frames_cuda(video_path, frame_interval, start_frame=0, end_frame=None, device=None):
+        """Decode frames straight into GPU memory with torchcodec's CUDA backend"""
+        if device is None:
+            device = torch.cuda.current_device()
+        decoder = VideoDecoder(video_path, device=f"cuda:{device}")
+        total_frames = len(decoder)
+        fps = decoder.metadata.average_fps
+        extracted = 0
+        if end_frame is None:
+            end_frame = total_frames
+        
+        print(f"[{pd.Timestamp.now()}] Starting GPU frame extraction from {video_path}")
+        
+        for frame_count in range(start_frame, min(end_frame, total_frames), frame_interval):
+            frame = decoder.get_frame_at(frame_count)
+            # Like the OpenCV path, timestamps count from the first frame regardless of the stream's start PTS
+            yield frame.data, frame_count / fps
+            extracted += 1
+            if frame_count % 100 == 0:
+                progress = (frame_count / total_frames) * 100
+                print(f"[{pd.Timestamp.now()}] Extracted {frame_count}/{total_frames} frames ({progress:.1f}%)")
+        
+        print(f"[{pd.Timestamp.now()}] Frame extraction complete. Extracted {extracted} frames")
+
+    def encode_and_store(self, frames, insert_batch_size=1000, prefetch=64):
+        """Encode (frame, timestamp) pairs and store in Milvus, returning the stored timestamps.
+
+        Decoding, GPU encoding and Milvus inserts run as a three-stage pipeline
+        (reader thread -> main thread -> writer thread) connected by bounded
+        queues, so only about `prefetch` frames are held in memory at a time.
+        """
+        return self._store_pipeline(frames, insert_batch_size, prefetch)
+
+    def encode_and_store_sharded(self, video_path, frame_interval=1, insert_batch_size=1000, prefetch=64):
+        """Encode a video across all visible GPUs and store in Milvus, returning the stored timestamps.
+
+        The frame range is split into one contiguous shard per GPU. Shard 0 goes through
+        the local encode_and_store pipeline; the rest are encoded by workers launched with
+        torch.multiprocessing.spawn, whose chunks are streamed into the same writer.
+        Falls back to encode_and_store on a single GPU or when the frame count is unknown.
+        """
+        num_gpus = torch.cuda.device_count()
+        total_frames = self.count_frames(video_path)
+        if num_gpus < 2 or total_frames < num_gpus * frame_interval:
+            return self.encode_and_store(self.extract_frames(video_path, frame_interval), insert_batch_size, prefetch)
+        
+        # Shard boundaries are multiples of frame_interval so sampling matches the single-GPU path.
+        # The frame count is only an estimate, so the last shard runs to the end of the video
+        shard_size = -(-total_frames // (num_gpus * frame_interval)) * frame_interval
+        shards = [(rank * shard_size, (rank + 1) * shard_size) for rank in range(num_gpus)]
+        shards[-1] = (shards[-1][0], None)
+        
+        print(f"[{pd.Timestamp.now()}] Starting encoding of ~{total_frames} frames on {num_gpus} GPUs")
+        # Bounded, so workers block instead of buffering their whole shard in host memory
+        result_q = mp.get_context("spawn").Queue(maxsize=2 * (num_gpus - 1))
+        workers = mp.spawn(
+            encode_shard,
+            args=(video_path, shards, self.model_path, self.compile_vision, frame_interval, self.batch_size, insert_batch_size, prefetch, result_q),
+            nprocs=num_gpus - 1,
+            join=False,
+            daemon=True
+        )
+        
+        def collect(write_q, errors, stop_event):
+            # Forward worker chunks to the local writer until every worker has sent its sentinel
+            remaining = num_gpus - 1
+            while remaining and not errors and not stop_event.is_set():
+                try:
+                    chunk = result_q.get(timeout=1)
+                except queue.Empty:
+                    try:
+                        workers.join(timeout=0)  # Raises if a worker died
+                    except Exception as e:
+                        errors.append(e)
+                    continue
+                if chunk is None:
+                    remaining -= 1
+                else:
+                    write_q.put(chunk)
+        
+        frames = self.extract_frames(video_path, frame_interval, *shards[0], device=torch.cuda.current_device())
+        try:
+            timestamps = self._store_pipeline(frames, insert_batch_size, prefetch, feeders=[collect])
+        except BaseException:
+            for process in workers.processes:
+                process.terminate()
+            raise
+        while not workers.join():
+            pass
+        return timestamps
+
+    def _store_pipeline(self, frames, insert_batch_size, prefetch, feeders=()):
+        """Encode frames locally and insert them, plus any chunks pushed by `feeders`, into Milvus.
+
+        Each feeder runs on its own thread as feeder(write_q, errors, stop_event), puts
+        (embeddings, timestamps) chunks into write_q and returns once stop_event is set.
+        Returns the sorted timestamps.
+        """
+        write_q = queue.Queue(maxsize=2)  # Items are whole insert chunks
+        stop_event = threading.Event()
+        errors = []
+        timestamps = []
+        
+        print(f"[{pd.Timestamp.now()}] Starting encoding and storage in Milvus")
+        writer_thread = threading.Thread(target=self._insert_chunks, args=(write_q, insert_batch_size, timestamps, errors), daemon=True)
+        feeder_threads = [threading.Thread(target=feeder, args=(write_q, errors, stop_event), daemon=True) for feeder in feeders]
+        writer_thread.start()
+        for thread in feeder_threads:
+            thread.start()
+        
+        try:
+            batches = iter_batches(frames, self.batch_size, prefetch)
+            for chunk in encode_chunks(self.embedder, batches, self.batch_size, insert_batch_size, errors):
+                write_q.put(chunk)
+            for thread in feeder_threads:
+                thread.join()
+        finally:
+            # Feeders must be gone before the sentinel, or they could block on a queue nobody drains
+            stop_event.set()
+            for thread in feeder_threads:
+                thread.join()
+            write_q.put(None)
+        
+        writer_thread.join()
+        if errors:
+            raise errors[0]
+        
+        self.create_index()
+        print(f"[{pd.Timestamp.now()}] Encoding and storage complete")
+        # Shards are inserted as they finish; cluster() orders rows by timestamp to match
+        return sorted(timestamps)
+
+    def _insert_chunks(self, write_q, insert_batch_size, timestamps, errors):
+        """Writer thread: insert (embeddings, timestamps) chunks from write_q until a None sentinel"""
+        embeddings, stamps = [], []
+        with tqdm(desc="Encoding frames", unit="frame") as pbar:
+            while True:
+                item = write_q.get()
+                if item is not None:
+                    embeddings.extend(item[0])
+                    stamps.extend(item[1])
+                    pbar.update(len(item[1]))
+                if embeddings and (item is None or len(embeddings) >= insert_batch_size):
+                    # Columnar insert: one RPC per chunk instead of one per frame
+                    if not errors:
+                        try:
+                            self.collection.insert([embeddings, stamps])
+                        except Exception as e:
+                            errors.append(e)
+                    timestamps.extend(stamps)
+                    embeddings, stamps = [], []
+                if item is None:
+                    break
+
+    @staticmethod
+    def count_frames(video_path):
+        """Best-effort frame count from the container metadata; 0 when unknown"""
+        cap = open_capture(video_path)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         cap.release()
-        print(f"[{pd.Timestamp.now()}] Frame extraction complete. Extracted {len(frame_list)} frames")
-        return frame_list, timestamps
-
-    def encode_and_store(self, frames, timestamps):
-        """Encode frames and store in Milvus"""
-        embeddings = []
-        total_frames = len(frames)
-        print(f"[{pd.Timestamp.now()}] Starting encoding of {total_frames} frames")
-        
-        for frame in tqdm(frames, desc="Encoding frames", unit="frame"):
-            # Convert OpenCV BGR frame to RGB
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            with torch.no_grad():
-                emb = self.embedder.encode_image(frame_rgb)
-                emb = emb.mean(dim=1).float().cpu().numpy()  # Convert to float32 then to numpy
-                embeddings.append(emb[0])
-        
-        print(f"[{pd.Timestamp.now()}] Starting storage in Milvus")
-        for i, (frame, embedding, timestamp) in enumerate(zip(frames, embeddings, timestamps)):
-            self.collection.insert({
-                "embedding": embedding,
-                "timestamp": timestamp
-            })
-            if (i + 1) % 10 == 0:
-                progress = ((i + 1) / total_frames) * 100
-                print(f"[{pd.Timestamp.now()}] Stored {i + 1}/{total_frames} frames ({progress:.1f}%)")
-        
-        # Create index
+        return max(total_frames, 0)
+
+    def create_index(self):
+        """Build an index on the embedding field and flush the collection"""
         print(f"[{pd.Timestamp.now()}] Creating index...")
+        # Nothing searches the collection (KNN is computed locally); load() just needs an index,
+        # and FLAT has no build cost
         index_params = {"index_type": "FLAT", "metric_type": "L2", "params": {}}
         self.collection.create_index(field_name="embedding", index_params=index_params)
         self.collection.flush()
-        print(f"[{pd.Timestamp.now()}] Encoding and storage complete")
 
-    def cluster(self, min_samples=3, min_cluster_size=24):
-        """Perform HDBSCAN clustering using precomputed distances from Milvus"""
+    def knn(self, embeddings, n_neighbors=50):
+        """Exact K nearest neighbors of every embedding, returning (squared L2 distances, indices)"""
+        n_neighbors = min(n_neighbors, len(embeddings))
+        if faiss is not None:
+            index = faiss.IndexFlatL2(embeddings.shape[1])
+            if faiss.get_num_gpus() > 0:
+                index = faiss.index_cpu_to_all_gpus(index)
+            index.add(embeddings)
+            return index.search(embeddings, n_neighbors)
+        
+        nn = NearestNeighbors(n_neighbors=n_neighbors).fit(embeddings)
+        distances, indices = nn.kneighbors(embeddings)
+        return distances ** 2, indices  # Match the squared L2 reported by faiss and Milvus
+
+    @staticmethod
+    def connect_components(dist_matrix, embeddings):
+        """Join the connected components of a sparse KNN distance graph.
+
+        Components are linked along a minimum spanning tree of their centroids. Each
+        tree edge becomes one graph edge between the members of the two components
+        closest to each other's centroid, weighted by their squared L2 distance.
+        """
+        num_components, component = connected_components(dist_matrix, directed=False)
+        if num_components == 1:
+            return dist_matrix
+        print(f"[{pd.Timestamp.now()}] Joining {num_components} disconnected components...")
+        
+        # Members of each component, and the component centroids
+        counts = np.bincount(component, minlength=num_components)
+        members = np.split(np.argsort(component, kind="stable"), np.cumsum(counts)[:-1])
+        centroids = np.stack([embeddings[idx].mean(axis=0) for idx in members])
+        
+        # Minimum spanning tree over the (squared L2) centroid distances
+        sq_norms = (centroids ** 2).sum(axis=1)
+        centroid_dist = sq_norms[:, None] + sq_norms[None, :] - 2 * centroids @ centroids.T
+        tree = minimum_spanning_tree(np.maximum(centroid_dist, MIN_DISTANCE)).tocoo()
+        
+        rows, cols, data = [], [], []
+        for a, b in zip(tree.row, tree.col):
+            i = members[a][np.argmin(((embeddings[members[a]] - centroids[b]) ** 2).sum(axis=1))]
+            j = members[b][np.argmin(((embeddings[members[b]] - centroids[a]) ** 2).sum(axis=1))]
+            distance = max(float(((embeddings[i] - embeddings[j]) ** 2).sum()), MIN_DISTANCE)
+            rows += [i, j]
+            cols += [j, i]
+            data += [distance, distance]
+        
+        bridges = csr_matrix((np.asarray(data, dtype=np.float32), (rows, cols)), shape=dist_matrix.shape)
+        return (dist_matrix + bridges).tocsr()
+
+    def cluster(self, min_samples=3, min_cluster_size=24, batch_size=1000, n_neighbors=50):
+        """Perform HDBSCAN clustering on a KNN graph of the embeddings stored in Milvus; labels follow timestamp order"""
         print(f"[{pd.Timestamp.now()}] Starting clustering process")
         self.collection.load()
         
-        # Retrieve embeddings and IDs
-        print(f"[{pd.Timestamp.now()}] Retrieving embeddings and computing distances...")
+        # Retrieve embeddings
+        print(f"[{pd.Timestamp.now()}] Retrieving embeddings...")
         iterator = self.collection.query_iterator(
-            batch_size=10, 
+            batch_size=batch_size, 
             expr="id > 0", 
-            output_fields=["id", "embedding"]
+            output_fields=["embedding", "timestamp"]
         )
         
-        ids = []
-        dist = {}
-        embeddings = []
-        search_params = {
-            "metric_type": "L2",
-            "params": {"nprobe": 10}
-        }
-
+        # Fill a preallocated float32 [N, dim] buffer instead of growing a list of vectors
+        embeddings = np.empty((max(self.collection.num_entities, 1), self.dim), dtype=np.float32)
+        timestamps = np.empty(len(embeddings), dtype=np.float64)
+        cursor = 0
         while True:
             batch = iterator.next()
             if len(batch) == 0:
                 break
                 
-            batch_ids = [data["id"] for data in batch]
-            ids.extend(batch_ids)
-            
-            query_vectors = [data["embedding"] for data in batch]
-            embeddings.extend(query_vectors)
-            
-            # Search for nearest neighbors for each vector
-            results = self.collection.search(
-                data=query_vectors,
-                limit=50,  # Number of nearest neighbors to consider
-                anns_field="embedding",
-                param=search_params,
-                output_fields=["id"]
-            )
-            
-            for i, batch_id in enumerate(batch_ids):
-                dist[batch_id] = []
-                for result in results[i]:
-                    dist[batch_id].append((result.id, result.distance))
-            
-            if len(embeddings) % 100 == 0:
-                print(f"[{pd.Timestamp.now()}] Processed {len(embeddings)} embeddings")
+            if cursor + len(batch) > len(embeddings):
+                grown = np.empty((max(2 * len(embeddings), cursor + len(batch)), self.dim), dtype=np.float32)
+                grown[:cursor] = embeddings[:cursor]
+                embeddings = grown
+                timestamps = np.resize(timestamps, len(embeddings))
+            for j, data in enumerate(batch):
+                embeddings[cursor + j] = data["embedding"]
+                timestamps[cursor + j] = data["timestamp"]
+            cursor += len(batch)
+            print(f"[{pd.Timestamp.now()}] Retrieved {cursor} embeddings")
+        iterator.close()
+        embeddings, timestamps = embeddings[:cursor], timestamps[:cursor]
+        
+        # Sharded encoding inserts chunks out of order; labels must follow the timestamp order
+        if np.any(np.diff(timestamps) < 0):
+            embeddings = embeddings[np.argsort(timestamps, kind="stable")]
+        
+        # The embeddings are already local, so compute the KNN graph here rather than searching Milvus again
+        print(f"[{pd.Timestamp.now()}] Computing nearest neighbors...")
+        distances, indices = self.knn(embeddings, n_neighbors)
         
-        # Create distance matrix
+        # Create sparse KNN distance graph; missing entries are treated as unreachable
         print(f"[{pd.Timestamp.now()}] Creating distance matrix...")
-        ids2index = {id: idx for idx, id in enumerate(ids)}
-        dist_matrix = np.full((len(ids), len(ids)), np.inf, dtype=np.float64)
+        # Flat int32/float32 COO arrays: half the footprint of int64/float64 and the
+        # index dtype csr_matrix uses anyway, so scipy does not have to copy them again
+        num_embeddings = len(embeddings)
+        rows = np.repeat(np.arange(num_embeddings, dtype=np.int32), indices.shape[1])
+        cols = indices.astype(np.int32, copy=False).ravel()
+        data = np.maximum(distances.astype(np.float32, copy=False).ravel(), MIN_DISTANCE)
         
-        for id in dist:
-            for result in dist[id]:
-                dist_matrix[ids2index[id]][ids2index[result[0]]] = result[1]
+        # Drop self matches and faiss' -1 padding
+        mask = (cols != rows) & (cols >= 0)
+        dist_matrix = csr_matrix((data[mask], (rows[mask], cols[mask])), shape=(num_embeddings, num_embeddings))
+        dist_matrix = dist_matrix.maximum(dist_matrix.T)
+        
+        # Sparse HDBSCAN rejects disconnected graphs, which a KNN graph of distinct scenes usually is
+        dist_matrix = self.connect_components(dist_matrix, embeddings)
         
         # Run HDBSCAN with precomputed distances
         print(f"[{pd.Timestamp.now()}] Running HDBSCAN clustering...")
@@ -184,15 +598,21 @@ class JanusClustering:
         labels = clusterer.fit_predict(dist_matrix)
         
         print(f"[{pd.Timestamp.now()}] Clustering complete. Found {len(set(labels)) - 1} clusters")
-        return labels, np.array(embeddings)
+        return labels, embeddings
 
-    def visualize(self, labels, embeddings):
+    def visualize(self, labels, embeddings, max_points=5000):
         """Visualize clusters using UMAP"""
         print(f"[{pd.Timestamp.now()}] Starting visualization process")
         
+        # UMAP is for plotting only, so a random subsample does not affect the clustering
+        if len(embeddings) > max_points:
+            rng = np.random.default_rng(42)
+            idx = rng.choice(len(embeddings), max_points, replace=False)
+            embeddings, labels = embeddings[idx], labels[idx]
+        
         # Reduce dimensions with UMAP
         print(f"[{pd.Timestamp.now()}] Running UMAP dimensionality reduction...")
-        umap = UMAP(n_components=2, random_state=42, n_neighbors=80, min_dist=0.1)
+        umap = UMAP(n_components=2, n_neighbors=30, min_dist=0.1, low_memory=True, n_jobs=-1)
         umap_embeddings = umap.fit_transform(embeddings)
         
         # Create DataFrame for visualization
@@ -212,29 +632,26 @@ class JanusClustering:
         )
         fig.show()
 
-def main():
-    # Configuration
-    model_path = "./models/Janus-Pro-7B"
-    milvus_uri = os.getenv("MILVUS_URI")
-    milvus_user = os.getenv("MILVUS_USER")
-    milvus_password = os.getenv("MILVUS_PASSWORD")
-    video_path = "./assets/scenario_01/2月13日.mp4"
-    
-    # Initialize and run clustering
-    clusterer = JanusClustering(model_path, milvus_uri, milvus_user, milvus_password)
-    # Create output directory if it doesn't exist
-    output_dir = "./output/segments/"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Extract frames and timestamps
-    frames, timestamps = clusterer.extract_frames(video_path)
-    clusterer.encode_and_store(frames, timestamps)
-    labels, embeddings = clusterer.cluster()
-    clusterer.visualize(labels, embeddings)
-    
-    # Split video into segments based on clustering
+def cut_segment(video_path, start_time, end_time, output_path):
+    """Cut [start_time, end_time) out of a video with ffmpeg stream copy. Returns True on success"""
+    ffmpeg_cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-ss", f"{start_time:.3f}", "-to", f"{end_time:.3f}",
+        "-i", video_path,
+        "-c", "copy", output_path
+    ]
+    try:
+        subprocess.run(ffmpeg_cmd, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"[{pd.Timestamp.now()}] FFmpeg stream copy failed, falling back to OpenCV: {e}")
+        return False
+    return True
+
+
+def split_video(video_path, labels, timestamps, output_dir):
+    """Write one video segment per (non-noise) cluster"""
     print(f"[{pd.Timestamp.now()}] Starting video segmentation")
-    cap = cv2.VideoCapture(video_path)
+    cap = open_capture(video_path)
     fps = cap.get(cv2.CAP_PROP_FPS)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -246,7 +663,15 @@ def main():
             cluster_groups[label] = []
         cluster_groups[label].append(i)
     
-    # Create video segments for each cluster
+    # Source frame number of every sampled frame; sampled positions only match decoded
+    # frame numbers when frame_interval == 1
+    source_frames = np.rint(np.asarray(timestamps) * fps).astype(np.int64)
+    
+    # Contiguous clusters are cut with ffmpeg stream copy, without decoding or re-encoding;
+    # everything else is left for the single OpenCV pass below
+    frame_to_cluster = np.full(source_frames.max() + 1 if len(source_frames) else 0, -1, dtype=np.int32)
+    writers = {}
+    output_paths = {}
     for label, frame_indices in cluster_groups.items():
         if label == -1:  # Skip noise
             continue
@@ -257,22 +682,62 @@ def main():
         
         # Create output video path
         output_path = os.path.join(output_dir, f"segment_{label}_{start_time:.1f}-{end_time:.1f}.mp4")
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
         
-        # Write frames to output video
-        for idx in frame_indices:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-            ret, frame = cap.read()
-            if ret:
-                out.write(frame)
+        is_contiguous = frame_indices[-1] - frame_indices[0] + 1 == len(frame_indices)
+        if is_contiguous and cut_segment(video_path, start_time, end_time + 1 / fps, output_path):
+            print(f"[{pd.Timestamp.now()}] Created segment: {output_path}")
+            continue
         
-        out.release()
-        print(f"[{pd.Timestamp.now()}] Created segment: {output_path}")
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        writers[label] = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        output_paths[label] = output_path
+        frame_to_cluster[source_frames[frame_indices]] = label
+    
+    # Single sequential decode feeding every remaining writer: no seeks, and frames
+    # outside those clusters are grabbed but never retrieved
+    if writers:
+        last_frame = np.flatnonzero(frame_to_cluster >= 0)[-1]
+        for idx in range(last_frame + 1):
+            if not cap.grab():
+                break
+            label = frame_to_cluster[idx]
+            if label >= 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    writers[label].write(frame)
+        
+        for label, out in writers.items():
+            out.release()
+            print(f"[{pd.Timestamp.now()}] Created segment: {output_paths[label]}")
     
     cap.release()
     print(f"[{pd.Timestamp.now()}] Video segmentation complete")
 
 
+def main():
+    # Configuration
+    model_path = "./models/Janus-Pro-7B"
+    milvus_uri = os.getenv("MILVUS_URI")
+    milvus_user = os.getenv("MILVUS_USER")
+    milvus_password = os.getenv("MILVUS_PASSWORD")
+    video_path = "./assets/scenario_01/2月13日.mp4"
+    transcode_mjpeg = False  # Pays off when the same video is decoded repeatedly
+    
+    # Initialize and run clustering
+    clusterer = JanusClustering(model_path, milvus_uri, milvus_user, milvus_password)
+    # Create output directory if it doesn't exist
+    output_dir = "./output/segments/"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Extract, encode and store frames
+    decode_path = transcode_to_mjpeg(video_path) if transcode_mjpeg else video_path
+    timestamps = clusterer.encode_and_store_sharded(decode_path)
+    labels, embeddings = clusterer.cluster()
+    clusterer.visualize(labels, embeddings)
+    
+    # Split video into segments based on clustering
+    split_video(video_path, labels, timestamps, output_dir)
+
+
 if __name__ == "__main__":
     main()
@@ -9,7 +9,7 @@ from io import BytesIO
 import base64
 
 class JanusEmbedder:
-    def __init__(self, model_path):
+    def __init__(self, model_path, compile_vision=False, compile_batch_size=32):
         # Initialize model and processor
         self.vl_chat_processor = VLChatProcessor.from_pretrained(
             model_path,
@@ -37,6 +37,28 @@ class JanusEmbedder:
                 trust_remote_code=True
             )
             self.vl_gpt = self.vl_gpt.to(torch.bfloat16).cuda().eval()
+        
+        # Optionally compile the vision tower + aligner for a fixed [compile_batch_size, 3, H, W] input
+        self.vision_encoder = self._encode_pixels
+        self.compile_batch_size = None
+        if compile_vision:
+            self.vision_encoder = torch.compile(self._encode_pixels, mode="max-autotune", dynamic=False, fullgraph=True)
+            self.compile_batch_size = compile_batch_size
+            self._warmup_vision_encoder()
+    
+    def _encode_pixels(self, pixel_values):
+        return self.vl_gpt.aligner(self.vl_gpt.vision_model(pixel_values))
+    
+    def _warmup_vision_encoder(self):
+        """Trigger compilation with a dummy batch of the target shape"""
+        image_size = self.vl_chat_processor.image_processor.image_size
+        dummy = torch.zeros(
+            (self.compile_batch_size, 3, image_size, image_size),
+            dtype=torch.bfloat16,
+            device=self.vl_gpt.device
+        )
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            self.vision_encoder(dummy)
     
     def encode_text(self, text):
         """Encode text into embedding vector"""
@@ -86,6 +108,51 @@ class JanusEmbedder:
         with torch.no_grad():
             return self.vl_gpt.prepare_inputs_embeds(**prepare_inputs)
     
+    def preprocess_tensor(self, frames):
+        """GPU equivalent of the Janus image processor for uint8 RGB tensors of shape [B, 3, H, W]"""
+        processor = self.vl_chat_processor.image_processor
+        image_size = processor.image_size
+        height, width = frames.shape[-2:]
+        
+        # Resize the longer side to image_size, keeping the aspect ratio
+        scale = image_size / max(height, width)
+        size = (max(int(height * scale), processor.min_size), max(int(width * scale), processor.min_size))
+        pixels = F.interpolate(frames.float(), size=size, mode="bicubic", align_corners=False, antialias=True)
+        
+        # Pad to a centered square filled with the background color
+        background = torch.tensor(processor.background_color, dtype=torch.float32, device=frames.device)
+        canvas = background.view(1, 3, 1, 1).repeat(frames.shape[0], 1, image_size, image_size)
+        top, left = (image_size - size[0]) // 2, (image_size - size[1]) // 2
+        canvas[:, :, top:top + size[0], left:left + size[1]] = pixels.clamp(0, 255)
+        
+        # Rescale and normalize
+        mean = torch.tensor(processor.image_mean, device=frames.device).view(1, 3, 1, 1)
+        std = torch.tensor(processor.image_std, device=frames.device).view(1, 3, 1, 1)
+        return (canvas * processor.rescale_factor - mean) / std
+    
+    def encode_image_batch(self, images):
+        """Encode a batch of images into image token embeddings of shape [B, T, D].
+        Accepts either a list of RGB numpy arrays or a uint8 RGB tensor of shape [B, 3, H, W]"""
+        if isinstance(images, torch.Tensor):
+            # Frames already on the GPU (e.g. NVDEC output) never go through the host
+            pixel_values = self.preprocess_tensor(images.to(self.vl_gpt.device)).to(torch.bfloat16)
+        else:
+            pil_images = [Image.fromarray(image) for image in images]
+            pixel_values = self.vl_chat_processor.image_processor(pil_images, return_tensors="pt").pixel_values
+            pixel_values = pixel_values.pin_memory().to(self.vl_gpt.device, dtype=torch.bfloat16, non_blocking=True)
+        
+        batch_size = len(pixel_values)
+        if self.compile_batch_size is not None and batch_size > self.compile_batch_size:
+            raise ValueError(f"Batch of {batch_size} exceeds the compiled batch size {self.compile_batch_size}")
+        if self.compile_batch_size is not None and batch_size < self.compile_batch_size:
+            # Pad a short final batch to the compiled shape instead of recompiling
+            padding = pixel_values.new_zeros((self.compile_batch_size - batch_size, *pixel_values.shape[1:]))
+            pixel_values = torch.cat([pixel_values, padding])
+        
+        # Run the vision tower once for the whole batch
+        with torch.inference_mode():
+            return self.vision_encoder(pixel_values)[:batch_size]
+    
     def calculate_similarity(self, text_emb, image_emb):
         """Calculate cosine similarity between text and image embeddings"""
         # Average embeddings across sequence length